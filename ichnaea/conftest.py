@@ -20,6 +20,7 @@ from ichnaea.api.locate.searcher import (
     configure_region_searcher,
 )
 from ichnaea.cache import configure_redis
+from ichnaea.data.export import API_KEY_CACHE, API_KEY_CACHE_LOCK
 from ichnaea.db import Database, configure_db, create_db, get_sqlalchemy_url
 from ichnaea.geocode import GEOCODER
 from ichnaea.geoip import CITY_RADII, configure_geoip
@@ -260,6 +261,8 @@ def independent_session(db_independent_session):
             )
     with API_CACHE_LOCK:
         API_CACHE.clear()
+    with API_KEY_CACHE_LOCK:
+        API_KEY_CACHE.clear()
 
 
 @pytest.fixture
@@ -284,6 +287,8 @@ def shared_session(db_shared_session):
             db_shared_session.has_session_fixture = False
     with API_CACHE_LOCK:
         API_CACHE.clear()
+    with API_KEY_CACHE_LOCK:
+        API_KEY_CACHE.clear()
 
 
 @pytest.fixture
@@ -494,12 +499,15 @@ def app(request, db, raven, redis):
 
 
 @pytest.fixture(scope="session")
-def global_celery(db_independent_session, geoip_db, raven_client, redis_client):
+def global_celery(
+    db_independent_session, geoip_db, http_session, raven_client, redis_client
+):
     """Yield and cleanup a taskapp based on independent sessions."""
     init_worker(
         celery_app,
         _db=db_independent_session,
         _geoip_db=geoip_db,
+        _http_session=http_session,
         _raven_client=raven_client,
         _redis_client=redis_client,
     )
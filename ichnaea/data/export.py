@@ -1,6 +1,7 @@
 from collections import defaultdict
 import json
 import re
+from threading import RLock
 import time
 from urllib.parse import urlparse
 import uuid
@@ -8,9 +9,10 @@ import uuid
 import boto3
 import boto3.exceptions
 import botocore.exceptions
+from cachetools import TTLCache
 import markus
+from more_itertools import chunked
 import redis.exceptions
-import requests
 import requests.exceptions
 from sqlalchemy import select
 import sqlalchemy.exc
@@ -39,6 +41,12 @@ WHITESPACE = re.compile(r"\s", flags=re.UNICODE)
 
 METRICS = markus.get_metrics()
 
+# Five minutes cache timeout for exported API keys known to the database.
+# Unknown keys are not cached, so newly created keys are tagged right away.
+API_KEY_CACHE_TIMEOUT = 300
+API_KEY_CACHE = TTLCache(maxsize=10000, ttl=API_KEY_CACHE_TIMEOUT)
+API_KEY_CACHE_LOCK = RLock()
+
 
 class IncomingQueue(object):
     """
@@ -163,7 +171,7 @@ class GeosubmitExporter(ReportExporter):
             "User-Agent": "ichnaea",
         }
 
-        response = requests.post(
+        response = self.task.http_session.post(
             self.config.url,
             data=util.encode_gzip(
                 json.dumps({"items": reports}).encode(), compresslevel=5
@@ -350,6 +358,7 @@ class InternalTransform(object):
 class InternalExporter(ReportExporter):
 
     _retriable = (IOError, redis.exceptions.RedisError, sqlalchemy.exc.InternalError)
+    _api_key_batch = 500
     transform = InternalTransform()
 
     def send(self, queue_items):
@@ -371,17 +380,36 @@ class InternalExporter(ReportExporter):
                 for action in ("drop", "upload"):
                     metrics[api_key]["%s_%s" % (type_, action)] = 0
 
-        with self.task.db_session(commit=False) as session:
-            # limit database session to get API keys
-            keys = [key for key in api_keys if key]
-            if keys:
-                columns = ApiKey.__table__.c
-                rows = session.execute(
-                    select([columns.valid_key]).where(columns.valid_key.in_(keys))
-                ).fetchall()
+        missing_keys = []
+        with API_KEY_CACHE_LOCK:
+            for api_key in api_keys:
+                if not api_key:
+                    continue
+                if api_key in API_KEY_CACHE:
+                    api_keys_known.add(api_key)
+                else:
+                    missing_keys.append(api_key)
 
-                for row in rows:
-                    api_keys_known.add(row.valid_key)
+        if missing_keys:
+            found_keys = set()
+            with self.task.db_session(commit=False) as session:
+                # limit database session to get API keys
+                columns = ApiKey.__table__.c
+                # Bound the size of each IN clause for large batches of keys
+                for key_batch in chunked(missing_keys, self._api_key_batch):
+                    rows = session.execute(
+                        select([columns.valid_key]).where(
+                            columns.valid_key.in_(key_batch)
+                        )
+                    ).fetchall()
+
+                    for row in rows:
+                        found_keys.add(row.valid_key)
+
+            with API_KEY_CACHE_LOCK:
+                for api_key in found_keys:
+                    API_KEY_CACHE[api_key] = True
+            api_keys_known.update(found_keys)
 
         positions = []
         observations = {"blue": [], "cell": [], "wifi": []}
@@ -4,6 +4,7 @@ import json
 import logging
 
 import markus
+from more_itertools import chunked
 from simple_pid import PID
 from sqlalchemy.exc import OperationalError
 
@@ -19,19 +20,28 @@ class ApiKeyLimits:
 
     def __call__(self):
         today = util.utcnow().strftime("%Y%m%d")
-        keys = self.task.redis_client.keys("apilimit:*:" + today)
+        # SCAN instead of KEYS, to not block Redis while matching keys
+        keys = list(
+            self.task.redis_client.scan_iter(match="apilimit:*:" + today, count=500)
+        )
         values = []
         if keys:
             values = self.task.redis_client.mget(keys)
             keys = [k.decode("utf-8").split(":")[1:3] for k in keys]
 
         for (api_key, path), value in zip(keys, values):
+            if value is None:
+                # The key expired after it was scanned
+                continue
             METRICS.gauge(
                 "api.limit", value=int(value), tags=["key:" + api_key, "path:" + path]
             )
 
 
 class ApiUsers:
+
+    _delete_batch = 1000
+
     def __init__(self, task):
         self.task = task
 
@@ -43,11 +53,11 @@ class ApiUsers:
             days[i] = day.strftime("%Y-%m-%d")
 
         metrics = defaultdict(list)
+        old_keys = []
         for key in self.task.redis_client.scan_iter(match="apiuser:*", count=100):
             _, api_type, api_name, day = key.decode("ascii").split(":")
             if day not in days.values():
-                # delete older entries
-                self.task.redis_client.delete(key)
+                old_keys.append(key)
                 continue
 
             if day == days[0]:
@@ -55,10 +65,20 @@ class ApiUsers:
 
             metrics[(api_type, api_name, "7d")].append(key)
 
-        for parts, keys in metrics.items():
-            api_type, api_name, interval = parts
-            value = self.task.redis_client.pfcount(*keys)
+        # Batch the commands, instead of a round trip per key. Without a
+        # transaction, Redis can serve other clients between the commands.
+        delete_batches = list(chunked(old_keys, self._delete_batch))
+        with self.task.redis_client.pipeline(transaction=False) as pipe:
+            for keys in delete_batches:
+                # delete older entries
+                pipe.delete(*keys)
+            for keys in metrics.values():
+                pipe.pfcount(*keys)
+            values = pipe.execute()
+        values = values[len(delete_batches) :]
 
+        for parts, value in zip(metrics.keys(), values):
+            api_type, api_name, interval = parts
             METRICS.gauge(
                 "%s.user" % api_type,
                 value=value,
@@ -1,12 +1,22 @@
 from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from csv import reader
 from datetime import datetime, timedelta
+from functools import lru_cache
+import gzip
+from io import BytesIO, TextIOWrapper
+from itertools import chain
 import logging
-import os
+from queue import Empty, Queue
+import shutil
+import subprocess
+from threading import Event
 
 import boto3
+import botocore.exceptions
 import colander
-from more_itertools import peekable
+from more_itertools import chunked
 from zoneinfo import ZoneInfo
 from sqlalchemy.sql import text
 from sqlalchemy.orm import load_only
@@ -20,6 +30,7 @@ from ichnaea import util
 
 LOGGER = logging.getLogger(__name__)
 UTC = ZoneInfo("UTC")
+S3_CLIENT = None  # Created on first use in each worker process
 
 _FIELD_NAMES = [
     "radio",
@@ -38,24 +49,22 @@ _FIELD_NAMES = [
     "averageSignal",
 ]
 
+# UMTS was the original name for WCDMA stations
+_RADIO_TYPE = {"UMTS": "wcdma", "GSM": "gsm", "LTE": "lte", "": "Unknown"}
+# Fallback for other spellings, so the common case needs no lower() per row
+_RADIO_TYPE_LOWER = {key.lower(): value for key, value in _RADIO_TYPE.items()}
 
-def write_stations_to_csv(session, path, today, start_time=None, end_time=None):
-    linesep = "\r\n"
+# The export repeats a lot of the same values, so a low compression level
+# keeps most of the size reduction at a fraction of the CPU cost. A faster
+# codec like zstd would need a matching change for download consumers.
+# If pigz is installed, it compresses using multiple cores instead.
+EXPORT_GZIP_LEVEL = 1
 
-    where = "lat IS NOT NULL AND lon IS NOT NULL"
-    if start_time is not None and end_time is not None:
-        where = where + ' AND modified >= "%s" AND modified < "%s"'
-        fmt = "%Y-%m-%d %H:%M:%S"
-        where = where % (start_time.strftime(fmt), end_time.strftime(fmt))
-    else:
-        # limit to cells modified in the last 12 months
-        one_year = today - timedelta(days=365)
-        where = where + ' AND modified >= "%s"' % one_year.strftime("%Y-%m-%d")
+# Limit pigz's threads, which compete with the workers on the same host.
+EXPORT_PIGZ_THREADS = 4
 
-    header_row = ",".join(_FIELD_NAMES) + linesep
 
-    tables = [shard.__tablename__ for shard in CellShard.shards().values()]
-    stmt = """SELECT
+_EXPORT_STMT = """SELECT
     `cellid`,
     CONCAT_WS(",",
         CASE radio
@@ -84,23 +93,316 @@ ORDER BY `cellid`
 LIMIT :limit
 """
 
-    with util.gzip_open(path, "w", compresslevel=5) as gzip_wrapper:
-        with gzip_wrapper as gzip_file:
-            gzip_file.write(header_row)
-            for table in tables:
-                table_stmt = text(stmt % (table, where))
-                min_cellid = ""
-                limit = 25000
+
+def _select_cell_rows(session, table, where, limit=25000):
+    """
+    Yield batches of export rows from one cell shard table.
+
+    Each batch is a complete query, using keyset pagination on ``cellid``.
+
+    :arg session: a database session
+    :arg table: the name of the cell shard table
+    :arg where: the SQL filter for exported cells
+    :arg limit: the number of rows in each batch
+    """
+    stmt = text(_EXPORT_STMT % (table, where))
+    min_cellid = ""
+    while True:
+        rows = session.execute(
+            stmt.bindparams(limit=limit, cellid=min_cellid)
+        ).fetchall()
+        if not rows:
+            break
+        yield rows
+        min_cellid = rows[-1].cellid
+
+
+def write_stations_to_csv(session, path, today, start_time=None, end_time=None):
+    """
+    Write a gzip-compressed public cell export CSV to a local file.
+
+    :arg session: a database session
+    :arg path: the path of the output .csv.gz file
+    :arg today: the current date, used to limit full exports
+    :arg start_time: the start of a diff export, or None
+    :arg end_time: the end of a diff export, or None
+    """
+    with open(path, "wb") as fd:
+        write_stations_to_gzip(
+            session, fd, today, start_time=start_time, end_time=end_time
+        )
+
+
+def write_stations_to_gzip(session, fileobj, today, start_time=None, end_time=None):
+    """
+    Write a gzip-compressed public cell export CSV to a binary file object.
+
+    The file object only needs ``write`` and ``flush`` methods, so the
+    compressed data can be streamed without a local file.
+
+    :arg session: a database session
+    :arg fileobj: a writable binary file object
+    :arg today: the current date, used to limit full exports
+    :arg start_time: the start of a diff export, or None
+    :arg end_time: the end of a diff export, or None
+    """
+    linesep = "\r\n"
+
+    where = "lat IS NOT NULL AND lon IS NOT NULL"
+    if start_time is not None and end_time is not None:
+        where = where + ' AND modified >= "%s" AND modified < "%s"'
+        fmt = "%Y-%m-%d %H:%M:%S"
+        where = where % (start_time.strftime(fmt), end_time.strftime(fmt))
+    else:
+        # limit to cells modified in the last 12 months
+        one_year = today - timedelta(days=365)
+        where = where + ' AND modified >= "%s"' % one_year.strftime("%Y-%m-%d")
+
+    header_row = ",".join(_FIELD_NAMES) + linesep
+
+    tables = [shard.__tablename__ for shard in CellShard.shards().values()]
+
+    # Read from the database in a separate thread, so waiting for the
+    # next batch overlaps with compressing and uploading the last one
+    batches = Queue(maxsize=4)
+    stop = Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        producer = executor.submit(
+            _queue_cell_rows, session, tables, where, batches, stop
+        )
+        try:
+            with _open_gzip_writer(fileobj) as gzip_file:
+                gzip_file.write(header_row)
                 while True:
-                    rows = session.execute(
-                        table_stmt.bindparams(limit=limit, cellid=min_cellid)
-                    ).fetchall()
-                    if rows:
-                        buf = "".join(row.cell_value + linesep for row in rows)
-                        gzip_file.write(buf)
-                        min_cellid = rows[-1].cellid
-                    else:
+                    rows = batches.get()
+                    if rows is None:
                         break
+                    # Index lookups on the cell_value column avoid the slower
+                    # attribute access and a string concatenation per row
+                    buf = linesep.join([row[1] for row in rows])
+                    gzip_file.write(buf + linesep)
+        finally:
+            # Unblock the producer, if it is waiting for space in the queue
+            stop.set()
+            while not producer.done():
+                try:
+                    batches.get(timeout=0.1)
+                except Empty:
+                    pass
+        # Raise any error from reading the database
+        producer.result()
+
+
+@contextmanager
+def _open_gzip_writer(fileobj):
+    """
+    Open a text stream, which is gzip compressed into a binary file object.
+
+    If pigz is installed, it compresses in a subprocess using multiple
+    cores. Otherwise the stream is compressed in this process.
+
+    :arg fileobj: a binary file object to write to
+    """
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        with gzip.open(
+            fileobj, "wt", compresslevel=EXPORT_GZIP_LEVEL, encoding="utf-8"
+        ) as gzip_file:
+            yield gzip_file
+        return
+
+    proc = subprocess.Popen(
+        [pigz, "-%d" % EXPORT_GZIP_LEVEL, "-p", str(EXPORT_PIGZ_THREADS), "-c"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Copy the compressed output, while this thread writes the input
+            copier = executor.submit(_copy_gzip_output, proc, fileobj)
+            try:
+                with TextIOWrapper(proc.stdin, encoding="utf-8") as gzip_file:
+                    yield gzip_file
+            except BaseException:
+                proc.kill()
+                if copier.exception() is None:
+                    raise
+            # An error writing the output is the cause of a broken input pipe
+            copier.result()
+    finally:
+        returncode = proc.wait()
+    if returncode != 0:
+        raise OSError("pigz failed with exit code %s" % returncode)
+
+
+def _copy_gzip_output(proc, fileobj):
+    """Copy the output of a compression subprocess to a file object."""
+    try:
+        while True:
+            # Forward each output chunk, as soon as it is available
+            data = proc.stdout.read1(16 * 1024 * 1024)
+            if not data:
+                break
+            fileobj.write(data)
+    except BaseException:
+        # Stop the subprocess, so writes to its input pipe fail
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+
+
+def _queue_cell_rows(session, tables, where, batches, stop):
+    """
+    Put batches of export rows from all cell shard tables on a queue.
+
+    A final None is put on the queue once all rows are read, or if
+    reading failed.
+
+    :arg session: a database session
+    :arg tables: the names of the cell shard tables
+    :arg where: the SQL filter for exported cells
+    :arg batches: the queue of row batches
+    :arg stop: an event, set if the rows are no longer needed
+    """
+    try:
+        for table in tables:
+            for rows in _select_cell_rows(session, table, where):
+                if stop.is_set():
+                    return
+                batches.put(rows)
+    finally:
+        batches.put(None)
+
+
+def s3_client():
+    """
+    Return the S3 client, shared by all cell exports in this process.
+
+    Reusing the client avoids repeating the credential lookup and keeps
+    its connection pool open between exports.
+    """
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        S3_CLIENT = boto3.client("s3")
+    return S3_CLIENT
+
+
+def reset_s3_client():
+    """Clear the S3 client, so the next export creates a new one."""
+    global S3_CLIENT
+    S3_CLIENT = None
+
+
+class S3MultipartWriter(object):
+    """
+    A write-only binary file object, uploading its data to S3.
+
+    Written data is buffered into parts, which are uploaded by a thread
+    pool as a S3 multipart upload while more data is written. If less
+    than one part is written in total, the data is uploaded in a single
+    request instead.
+
+    Used as a context manager, the upload is completed on exit, or
+    aborted if an exception was raised.
+    """
+
+    def __init__(self, client, bucket, key, part_size=16 * 1024 * 1024, workers=4):
+        """
+        :arg client: a boto3 S3 client
+        :arg bucket: the name of the S3 bucket
+        :arg key: the name of the S3 object
+        :arg part_size: the minimum part size in bytes, at least 5 MB
+        :arg workers: the maximum number of parts uploaded at the same time
+        """
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.workers = workers
+        self._buffer = BytesIO()
+        self._executor = None
+        self._parts = []
+        self._upload_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self._buffer.write(data)
+        if self._buffer.tell() >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )
+            self._upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        # Limit the number of buffered parts waiting for an upload slot
+        if len(self._parts) >= self.workers:
+            self._parts[-self.workers].result()
+
+        body = self._buffer.getvalue()
+        self._buffer = BytesIO()
+        self._parts.append(
+            self._executor.submit(
+                self.client.upload_part,
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                PartNumber=len(self._parts) + 1,
+                Body=body,
+            )
+        )
+
+    def close(self):
+        """Upload the remaining data and complete the upload."""
+        if self._upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=self._buffer.getvalue()
+            )
+            return
+
+        try:
+            if self._buffer.tell():
+                self._upload_part()
+            parts = [
+                {"ETag": future.result()["ETag"], "PartNumber": number}
+                for number, future in enumerate(self._parts, 1)
+            ]
+            self._executor.shutdown()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Abort the upload, discarding any uploaded parts."""
+        if self._upload_id is None:
+            return
+
+        self._executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+        )
 
 
 class InvalidCSV(ValueError):
@@ -109,7 +411,149 @@ class InvalidCSV(ValueError):
     pass
 
 
-def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
+@lru_cache(maxsize=4096)
+def _ts_to_utc(timestamp):
+    """
+    Convert a Unix timestamp to a UTC datetime.
+
+    Exports repeat the same timestamps across many rows, so the datetime
+    objects are cached and shared.
+
+    :arg timestamp: the timestamp, in seconds
+    """
+    return datetime.fromtimestamp(timestamp, UTC)
+
+
+def _validate_station_row(row):
+    """
+    Validate a row of a public cell export CSV.
+
+    This is a module-level function, so it can run in a worker process.
+
+    :arg row: a list of CSV values
+    :return: a tuple (row, validated, error). validated is a dict of the
+        CellShard values, or None. error is a description of why the row
+        is invalid, or None. If both are None, the radio type is empty.
+        row is only returned if validated is None, and is None otherwise.
+    :raises InvalidCSV: if the radio type is unknown
+    """
+    try:
+        radio = _RADIO_TYPE[row[0]]
+    except KeyError:
+        radio = _RADIO_TYPE_LOWER.get(row[0].lower())
+        if radio is None:
+            raise InvalidCSV("Unknown radio type in row: %s" % row)
+
+    if radio == "Unknown":
+        return row, None, None
+
+    try:
+        data = {
+            "radio": radio,
+            "mcc": int(row[1]),
+            "mnc": int(row[2]),
+            "lac": int(row[3]),
+            "cid": int(row[4]),
+            "psc": int(row[5]) if row[5] else 0,
+            "lon": float(row[6]),
+            "lat": float(row[7]),
+            # Some exported radiuses exceed the max and fail validation
+            "radius": min(int(row[8]), CELL_MAX_RADIUS),
+            "samples": int(row[9]),
+            # row[10] is "changable", always 1 and not imported
+            "created": _ts_to_utc(int(row[11])),
+            "modified": _ts_to_utc(int(row[12])),
+        }
+        validated = CellShard.validate(data, _raise_invalid=True)
+    except (colander.Invalid, ValueError) as e:
+        return row, None, str(e)
+    # Avoid sending the raw row back from a worker process
+    return None, validated, None
+
+
+def _validate_in_pool(pool, rows, size=20000):
+    """
+    Validate CSV rows in a multiprocessing pool.
+
+    The rows are sent to the pool in slices. The next slice is validated
+    while the results of the last one are processed, so at most two
+    slices are held in memory.
+
+    :arg pool: a multiprocessing Pool
+    :arg rows: an iterable of CSV rows
+    :arg size: the number of rows in each slice
+    :return: an iterator of _validate_station_row results, in order
+    """
+    pending = None
+    for rows_slice in chunked(rows, size):
+        result = pool.map_async(_validate_station_row, rows_slice, chunksize=500)
+        if pending is not None:
+            yield from pending.get()
+        pending = result
+    if pending is not None:
+        yield from pending.get()
+
+
+def _merge_stations(session, shards):
+    """
+    Add new stations and update outdated stations in the database.
+
+    The existing stations are loaded with one query per shard table,
+    instead of one query per station.
+
+    :arg session: a database session
+    :arg shards: a list of validated CellShard instances
+    :return: a list of (shard, operation) tuples, with operation one of
+        "new", "updated" or "found"
+    """
+    by_type = defaultdict(list)
+    for shard in shards:
+        by_type[shard.__class__].append(shard)
+
+    result = []
+    for shard_type, type_shards in by_type.items():
+        cellids = list({shard.cellid for shard in type_shards})
+        query = (
+            session.query(shard_type)
+            .filter(shard_type.cellid.in_(cellids))
+            .options(load_only("modified"))
+        )
+        existing = {station.cellid: station for station in query}
+
+        for shard in type_shards:
+            station = existing.get(shard.cellid)
+            if station is not None:
+                if station.modified < shard.modified:
+                    # Update existing station with new data
+                    operation = "updated"
+                    station.psc = shard.psc
+                    station.lon = shard.lon
+                    station.lat = shard.lat
+                    station.radius = shard.radius
+                    station.samples = shard.samples
+                    station.created = shard.created
+                    station.modified = shard.modified
+                else:
+                    # Do nothing to existing station record
+                    operation = "found"
+            else:
+                # Add a new station record
+                operation = "new"
+                shard.min_lat = shard.lat
+                shard.max_lat = shard.lat
+                shard.min_lon = shard.lon
+                shard.max_lon = shard.lon
+                session.add(shard)
+                # A later row for the same station is merged into this one
+                existing[shard.cellid] = shard
+
+            result.append((shard, operation))
+    return result
+
+
+def read_stations_from_csv(
+    session, file_handle, redis_client, cellarea_queue, pool=None
+):
     """
     Read stations from a public cell export CSV.
 
@@ -117,113 +561,69 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
     :arg file_handle: an open file handle for the CSV data
     :arg redis_client: a Redis client
     :arg cellarea_queue: the DataQueue for updating cellarea IDs
+    :arg pool: an optional multiprocessing Pool, to validate rows in
+        worker processes
     """
     # Avoid circular imports
     from ichnaea.data.tasks import update_cellarea, update_statregion
 
-    csv_content = peekable(reader(file_handle))
-    # UMTS was the original name for WCDMA stations
-    radio_type = {"UMTS": "wcdma", "GSM": "gsm", "LTE": "lte", "": "Unknown"}
+    # A plain reader, rather than a peekable one, avoids a Python-level
+    # wrapper call for every row of a large import
+    csv_content = reader(file_handle)
 
     counts = defaultdict(Counter)
     areas = set()
     areas_total = 0
     total = 0
 
-    if not csv_content:
+    first_row = next(csv_content, None)
+    if first_row is None:
         LOGGER.warning("Nothing to process.")
         return
 
-    first_row = csv_content.peek()
-    if first_row == _FIELD_NAMES:
-        # Skip the first row because it's a header row
-        next(csv_content)
-    else:
+    if first_row != _FIELD_NAMES:
         LOGGER.warning("Expected header row, got data: %s", first_row)
+        # Process the first row as data, since it's not a header row
+        csv_content = chain([first_row], csv_content)
 
-    for row in csv_content:
-        try:
-            radio = radio_type[row[0]]
-        except KeyError:
-            raise InvalidCSV("Unknown radio type in row: %s" % row)
+    if pool is None:
+        results = map(_validate_station_row, csv_content)
+    else:
+        results = _validate_in_pool(pool, csv_content)
+
+    def valid_stations():
+        valid = 0
+        for row, validated, error in results:
+            if error is not None:
+                if valid == 0:
+                    # If the first row is invalid, it's likely the rest of the
+                    # file is, too--drop out here.
+                    raise InvalidCSV("first row %s is invalid: %s" % (row, error))
+                else:
+                    LOGGER.warning("row %s is invalid: %s", row, error)
+                    continue
+
+            if validated is None:
+                LOGGER.warning("Skipping unknown radio: %s", row)
+                continue
 
-        if radio == "Unknown":
-            LOGGER.warning("Skipping unknown radio: %s", row)
-            continue
+            valid += 1
+            yield CellShard.shard_model(validated["radio"])(**validated)
 
-        try:
-            data = {
-                "radio": radio,
-                "mcc": int(row[1]),
-                "mnc": int(row[2]),
-                "lac": int(row[3]),
-                "cid": int(row[4]),
-                "psc": int(row[5]) if row[5] else 0,
-                "lon": float(row[6]),
-                "lat": float(row[7]),
-                # Some exported radiuses exceed the max and fail validation
-                "radius": min(int(row[8]), CELL_MAX_RADIUS),
-                "samples": int(row[9]),
-                # row[10] is "changable", always 1 and not imported
-                "created": datetime.fromtimestamp(int(row[11]), UTC),
-                "modified": datetime.fromtimestamp(int(row[12]), UTC),
-            }
-            shard = CellShard.create(_raise_invalid=True, **data)
-        except (colander.Invalid, ValueError) as e:
-            if total == 0:
-                # If the first row is invalid, it's likely the rest of the
-                # file is, too--drop out here.
-                raise InvalidCSV("first row %s is invalid: %s" % (row, e))
-            else:
-                LOGGER.warning("row %s is invalid: %s", row, e)
-                continue
+    # Process a chunk of stations, report on progress
+    for batch in chunked(valid_stations(), 1000):
+        for shard, operation in _merge_stations(session, batch):
+            counts[shard.radio.name][operation] += 1
 
-        # Is this station in the database?
-        shard_type = shard.__class__
-        existing = (
-            session.query(shard_type)
-            .filter(shard_type.cellid == shard.cellid)
-            .options(load_only("modified"))
-            .one_or_none()
-        )
+            # Process the cell area?
+            if operation in {"new", "updated"}:
+                areas.add(area_id(shard))
 
-        if existing:
-            if existing.modified < data["modified"]:
-                # Update existing station with new data
-                operation = "updated"
-                existing.psc = shard.psc
-                existing.lon = shard.lon
-                existing.lat = shard.lat
-                existing.radius = shard.radius
-                existing.samples = shard.samples
-                existing.created = shard.created
-                existing.modified = shard.modified
-            else:
-                # Do nothing to existing station record
-                operation = "found"
-        else:
-            # Add a new station record
-            operation = "new"
-            shard.min_lat = shard.lat
-            shard.max_lat = shard.lat
-            shard.min_lon = shard.lon
-            shard.max_lon = shard.lon
-            session.add(shard)
-
-        counts[data["radio"]][operation] += 1
-
-        # Process the cell area?
-        if operation in {"new", "updated"}:
-            areas.add(area_id(shard))
-
-        # Process a chunk of stations, report on progress
-        total += 1
-        if total % 1000 == 0:
-            session.commit()
-            LOGGER.info("Processed %d stations", total)
-
-        if areas and (len(areas) % 1000 == 0):
-            session.commit()
+        total += len(batch)
+        session.commit()
+        LOGGER.info("Processed %d stations", total)
+
+        if len(areas) >= 1000:
             areas_total += len(areas)
             LOGGER.info("Processed %d station areas", areas_total)
             with redis_pipeline(redis_client) as pipe:
@@ -231,9 +631,6 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
             update_cellarea.delay()
             areas = set()
 
-    # Commit remaining station data
-    session.commit()
-
     # Update the remaining cell areas
     if areas:
         areas_total += len(areas)
@@ -291,16 +688,19 @@ class CellExport(object):
         filename = "MLS-%s-cell-export-" % file_type
         filename = filename + file_time.strftime("%Y-%m-%dT%H0000.csv.gz")
 
-        with util.selfdestruct_tempdir() as temp_dir:
-            path = os.path.join(temp_dir, filename)
+        try:
             with self.task.db_session(commit=False) as session:
-                write_stations_to_csv(
-                    session, path, today, start_time=start_time, end_time=end_time
-                )
-            self.write_stations_to_s3(path, bucket)
-
-    def write_stations_to_s3(self, path, bucketname):
-        s3 = boto3.resource("s3")
-        bucket = s3.Bucket(bucketname)
-        obj = bucket.Object("export/" + os.path.split(path)[-1])
-        obj.upload_file(path)
+                with S3MultipartWriter(
+                    s3_client(), bucket, "export/" + filename
+                ) as fileobj:
+                    write_stations_to_gzip(
+                        session,
+                        fileobj,
+                        today,
+                        start_time=start_time,
+                        end_time=end_time,
+                    )
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+            # Start the task retry with a fresh client and connections
+            reset_s3_client()
+            raise
@@ -6,9 +6,14 @@ import boto3
 import pytest
 import requests_mock
 
-from ichnaea.data.export import DummyExporter, InternalTransform
+from ichnaea.data.export import (
+    API_KEY_CACHE,
+    DummyExporter,
+    InternalExporter,
+    InternalTransform,
+)
 from ichnaea.data.tasks import update_blue, update_cell, update_incoming, update_wifi
-from ichnaea.models import BlueShard, CellShard, WifiShard
+from ichnaea.models import ApiKey, BlueShard, CellShard, WifiShard
 from ichnaea.tests.factories import (
     ApiKeyFactory,
     BlueShardFactory,
@@ -215,6 +220,28 @@ class TestGeosubmit(BaseExportTest):
         )
         metricsmock.assert_timing_once("data.export.upload.timing", tags=["key:test"])
 
+    def test_upload_http_session(self, celery, session, http_session):
+        ExportConfigFactory(
+            name="test",
+            batch=2,
+            schema="geosubmit",
+            url="http://127.0.0.1:9/v2/geosubmit?key=external",
+        )
+        session.flush()
+        self.add_reports(celery, 4)
+
+        assert celery.http_session is http_session
+        with requests_mock.Mocker() as req_mock:
+            req_mock.register_uri("POST", requests_mock.ANY, text="{}")
+            with mock.patch.object(
+                http_session, "post", wraps=http_session.post
+            ) as post:
+                update_incoming.delay().get()
+
+        # both batches are posted through the worker's pooled session
+        assert post.call_count == 2
+        assert req_mock.call_count == 2
+
 
 class TestS3(BaseExportTest):
     def test_upload(self, celery, session, metricsmock):
@@ -528,6 +555,47 @@ class TestInternal(BaseExportTest):
             ("data.station.new", ("type:wifi",)): 24,
         }
 
+    def test_stats_key_batches(self, celery, session, metricsmock):
+        ApiKeyFactory(valid_key="e5444-794")
+        session.flush()
+
+        self.add_reports(celery, 2)
+        self.add_reports(celery, 1, api_key="e5444-794")
+        self.add_reports(celery, 1, api_key="unknown")
+        with mock.patch.object(InternalExporter, "_api_key_batch", 1):
+            self._update_all(session, datamap_only=True)
+
+        metricsmock.assert_incr_once("data.report.upload", value=2, tags=["key:test"])
+        metricsmock.assert_incr_once(
+            "data.report.upload", value=1, tags=["key:e5444-794"]
+        )
+        metricsmock.assert_incr_once("data.report.upload", value=1, tags=[])
+
+    def test_stats_key_cache(self, celery, session, metricsmock):
+        self.add_reports(celery, 1, api_key="e5444-794")
+        self._update_all(session, datamap_only=True)
+        metricsmock.assert_incr_once("data.report.upload", value=1, tags=[])
+
+        # Unknown keys are not cached, a new key is tagged right away
+        ApiKeyFactory(valid_key="e5444-794")
+        session.flush()
+        self.add_reports(celery, 1, api_key="e5444-794")
+        update_incoming.delay().get()
+        metricsmock.assert_incr_once(
+            "data.report.upload", value=1, tags=["key:e5444-794"]
+        )
+        assert "e5444-794" in API_KEY_CACHE
+
+        # Known keys are served from the cache, until it expires
+        session.query(ApiKey).filter(ApiKey.valid_key == "e5444-794").delete()
+        session.flush()
+        self.add_reports(celery, 1, api_key="e5444-794")
+        update_incoming.delay().get()
+        records = metricsmock.filter_records(
+            "incr", "data.report.upload", tags=["key:e5444-794"]
+        )
+        assert len(records) == 2
+
     def test_blue(self, celery, session):
         reports = self.add_reports(celery, blue_factor=1, cell_factor=0, wifi_factor=0)
         self._update_all(session)
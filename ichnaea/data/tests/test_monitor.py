@@ -7,6 +7,7 @@ from unittest import mock
 import pytest
 from sqlalchemy.exc import OperationalError
 
+from ichnaea.data.monitor import ApiUsers
 from ichnaea.data.tasks import (
     monitor_api_key_limits,
     monitor_api_users,
@@ -65,6 +66,16 @@ class TestMonitorApiKeys:
             "api.limit", value=15, tags=["key:no_key_2", "path:v1.geolocate"]
         )
 
+    def test_monitor_api_keys_expired(self, celery, redis, metricsmock):
+        today = util.utcnow().strftime("%Y%m%d")
+        rate_key = "apilimit:no_key_1:v1.geolocate:" + today
+        redis.incr(rate_key, 13)
+
+        # The key expires between the scan and reading its value
+        with mock.patch("ichnaea.cache.RedisClient.mget", return_value=[None]):
+            monitor_api_key_limits.delay().get()
+        metricsmock.assert_not_gauge("api.limit")
+
 
 class TestMonitorAPIUsers:
     @property
@@ -130,6 +141,25 @@ class TestMonitorAPIUsers:
         # the too old key was deleted manually
         assert not redis.exists("apiuser:submit:test:" + days_7)
 
+    def test_old_days_deleted_in_batches(self, celery, geoip_data, redis, metricsmock):
+        bhutan_ip = geoip_data["Bhutan"]["ip"]
+        redis.pfadd("apiuser:submit:test:" + self.today_str, bhutan_ip)
+        old_keys = []
+        for days in range(7, 12):
+            day = (self.today - timedelta(days=days)).strftime("%Y-%m-%d")
+            old_keys.append("apiuser:submit:test:" + day)
+            redis.pfadd(old_keys[-1], bhutan_ip)
+
+        with mock.patch.object(ApiUsers, "_delete_batch", 2):
+            monitor_api_users.delay().get()
+        metricsmock.assert_gauge_once(
+            "submit.user", value=1, tags=["key:test", "interval:1d"]
+        )
+        metricsmock.assert_gauge_once(
+            "submit.user", value=1, tags=["key:test", "interval:7d"]
+        )
+        assert not redis.exists(*old_keys)
+
 
 @pytest.fixture
 def monitor_session():
@@ -1,17 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import gzip
 import os
 import re
 from datetime import datetime, timedelta
-from io import StringIO
+from io import BytesIO, StringIO
+from multiprocessing import Pool
 from unittest import mock
 
 import boto3
+import botocore.exceptions
 import pytest
 from zoneinfo import ZoneInfo
 from sqlalchemy import func
 
+from ichnaea.data import public
 from ichnaea.data.public import (
     read_stations_from_csv,
+    S3MultipartWriter,
     write_stations_to_csv,
     InvalidCSV,
 )
@@ -45,8 +51,22 @@ class FakeTask(object):
         self.app = app
 
 
+@pytest.fixture(params=["gzip", "pigz"])
+def pigz(request, tmp_path):
+    """Return the path to pigz, or None to compress exports in-process."""
+    if request.param == "gzip":
+        return None
+    # A stand-in for pigz, using the single-threaded gzip command
+    path = tmp_path / "pigz"
+    path.write_text(
+        '#!/bin/sh\n# Drop the "-p <threads>" option\nexec gzip "$1" "$4"\n'
+    )
+    path.chmod(0o755)
+    return str(path)
+
+
 class TestExport(object):
-    def test_local_export(self, celery, session):
+    def test_local_export(self, celery, session, pigz):
         now = util.utcnow()
         today = now.date()
         long_ago = now - timedelta(days=367)
@@ -85,7 +105,8 @@ class TestExport(object):
 
         with util.selfdestruct_tempdir() as temp_dir:
             path = os.path.join(temp_dir, "export.csv.gz")
-            write_stations_to_csv(session, path, today)
+            with mock.patch("ichnaea.data.public.shutil.which", return_value=pigz):
+                write_stations_to_csv(session, path, today)
 
             with util.gzip_open(path, "r") as gzip_wrapper:
                 with gzip_wrapper as gzip_file:
@@ -106,25 +127,40 @@ class TestExport(object):
 
                     assert cells == exported_cells
 
+    def test_keyset_pagination(self, celery, session):
+        """The rows are read in pages, ordered by cellid."""
+        for radio in (Radio.gsm, Radio.wcdma):
+            CellShardFactory.create_batch(7, radio=radio)
+        session.commit()
+
+        model = CellShard.shard_model(Radio.gsm)
+        where = "lat IS NOT NULL AND lon IS NOT NULL"
+        pages = list(
+            public._select_cell_rows(session, model.__tablename__, where, limit=3)
+        )
+
+        assert [len(rows) for rows in pages] == [3, 3, 1]
+        cellids = [row.cellid for rows in pages for row in rows]
+        assert cellids == sorted(cell.cellid for cell in session.query(model))
+
     def test_export_diff(self, celery, session):
         CellShardFactory.create_batch(10, radio=Radio.gsm)
         session.commit()
         pattern = re.compile(r"MLS-diff-cell-export-\d+-\d+-\d+T\d+0000\.csv\.gz")
 
-        mock_conn = mock.MagicMock()
-        mock_bucket = mock.MagicMock(name="bucket")
-        mock_obj = mock.MagicMock()
-        mock_conn.return_value.Bucket.return_value = mock_bucket
-        mock_bucket.Object.return_value = mock_obj
-
-        with mock.patch.object(boto3, "resource", mock_conn):
+        mock_client = mock.MagicMock(name="client")
+        with mock.patch.object(public, "S3_CLIENT", None), mock.patch.object(
+            boto3, "client", return_value=mock_client
+        ):
             cell_export_diff(_bucket="bucket")
 
-        s3_key = mock_bucket.Object.call_args[0][0]
-        assert pattern.search(s3_key)
+        kwargs = mock_client.put_object.call_args[1]
+        assert kwargs["Bucket"] == "bucket"
+        assert kwargs["Key"].startswith("export/")
+        assert pattern.search(kwargs["Key"])
 
-        tmp_file = mock_obj.upload_file.call_args[0][0]
-        assert pattern.search(tmp_file)
+        lines = util.decode_gzip(kwargs["Body"]).decode("utf-8").splitlines()
+        assert lines[0].startswith("radio,mcc,net,area,cell,")
 
     def test_export_full(self, celery, session):
         now = util.utcnow()
@@ -139,20 +175,201 @@ class TestExport(object):
         session.commit()
         pattern = re.compile(r"MLS-full-cell-export-\d+-\d+-\d+T000000\.csv\.gz")
 
-        mock_conn = mock.MagicMock()
-        mock_bucket = mock.MagicMock(name="bucket")
-        mock_obj = mock.MagicMock()
-        mock_conn.return_value.Bucket.return_value = mock_bucket
-        mock_bucket.Object.return_value = mock_obj
+        mock_client = mock.MagicMock(name="client")
+        with mock.patch.object(public, "S3_CLIENT", None), mock.patch.object(
+            boto3, "client", return_value=mock_client
+        ):
+            cell_export_full(_bucket="bucket")
+
+        kwargs = mock_client.put_object.call_args[1]
+        assert kwargs["Bucket"] == "bucket"
+        assert pattern.search(kwargs["Key"])
+
+        # the really old cell is not exported
+        lines = util.decode_gzip(kwargs["Body"]).decode("utf-8").splitlines()
+        assert len(lines) == 11
 
-        with mock.patch.object(boto3, "resource", mock_conn):
+    def test_export_reuses_client(self, celery, session):
+        mock_client = mock.MagicMock(name="client")
+        with mock.patch.object(public, "S3_CLIENT", None), mock.patch.object(
+            boto3, "client", return_value=mock_client
+        ) as mock_create:
+            cell_export_diff(_bucket="bucket")
             cell_export_full(_bucket="bucket")
 
-        s3_key = mock_bucket.Object.call_args[0][0]
-        assert pattern.search(s3_key)
+        assert mock_create.call_count == 1
+        assert mock_client.put_object.call_count == 2
+
+    def test_export_s3_error_resets_client(self, celery, raven, session):
+        mock_client = mock.MagicMock(name="client")
+        mock_client.put_object.side_effect = (
+            botocore.exceptions.EndpointConnectionError(
+                endpoint_url="https://s3.amazonaws.com"
+            )
+        )
+        with mock.patch.object(public, "S3_CLIENT", None), mock.patch.object(
+            boto3, "client", return_value=mock_client
+        ):
+            with pytest.raises(botocore.exceptions.EndpointConnectionError):
+                cell_export_diff(_bucket="bucket")
+            assert public.S3_CLIENT is None
+
+        raven.check([("EndpointConnectionError", 1)])
+
+
+class TestExportPipeline(object):
+    """Test the export's database reader and compressing writer threads."""
+
+    def _write(self, fileobj, pigz=None):
+        # Run in a thread, so a deadlock fails the test instead of hanging
+        with mock.patch("ichnaea.data.public.shutil.which", return_value=pigz):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(
+                    public.write_stations_to_gzip, None, fileobj, util.utcnow().date()
+                )
+                return future.result(timeout=30)
+
+    def test_batches(self, pigz):
+        def select_rows(session, table, where):
+            for i in range(3):
+                yield [(i, "%s,%s" % (table, i))]
+
+        fileobj = BytesIO()
+        with mock.patch.object(public, "_select_cell_rows", select_rows):
+            self._write(fileobj, pigz=pigz)
+
+        lines = gzip.decompress(fileobj.getvalue()).decode().split("\r\n")
+        assert lines[0].startswith("radio,mcc,net,area,cell,")
+        assert lines[1:4] == ["cell_gsm,0", "cell_gsm,1", "cell_gsm,2"]
+        assert len(lines) == 1 + 3 * len(CellShard.shards()) + 1
+
+    def test_database_error(self, pigz):
+        def select_rows(session, table, where):
+            yield [(0, "row")]
+            raise IOError("lost connection")
+
+        with mock.patch.object(public, "_select_cell_rows", select_rows):
+            with pytest.raises(IOError, match="lost connection"):
+                self._write(BytesIO(), pigz=pigz)
+
+    def test_write_error(self, pigz):
+        state = {"batches": 0}
+
+        def select_rows(session, table, where):
+            while True:
+                state["batches"] += 1
+                # Incompressible rows, so the writes reach the file object
+                yield [(i, os.urandom(100).hex()) for i in range(1000)]
+
+        class FailingFile(BytesIO):
+            def write(self, data):
+                if self.tell() > 100000:
+                    raise IOError("upload failed")
+                return super().write(data)
+
+        with mock.patch.object(public, "_select_cell_rows", select_rows):
+            with pytest.raises(IOError, match="upload failed"):
+                self._write(FailingFile(), pigz=pigz)
+
+        # The reader stopped early
+        assert state["batches"] < 100
+
+
+class TestS3MultipartWriter(object):
+    def _client(self):
+        client = mock.MagicMock(name="client")
+        client.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+        client.upload_part.side_effect = lambda **kw: {
+            "ETag": "etag-%s" % kw["PartNumber"]
+        }
+        return client
+
+    def test_single_put(self):
+        client = self._client()
+        with S3MultipartWriter(client, "bucket", "key", part_size=10) as fileobj:
+            fileobj.write(b"abc")
+            fileobj.write(b"def")
+
+        client.put_object.assert_called_once_with(
+            Bucket="bucket", Key="key", Body=b"abcdef"
+        )
+        assert not client.create_multipart_upload.called
+
+    def test_multipart(self):
+        client = self._client()
+        with S3MultipartWriter(
+            client, "bucket", "key", part_size=10, workers=2
+        ) as fileobj:
+            for i in range(5):
+                fileobj.write(b"x" * 6)
+
+        assert not client.put_object.called
+        bodies = [
+            call[1]["Body"]
+            for call in sorted(
+                client.upload_part.call_args_list, key=lambda c: c[1]["PartNumber"]
+            )
+        ]
+        assert bodies == [b"x" * 12, b"x" * 12, b"x" * 6]
+        client.complete_multipart_upload.assert_called_once_with(
+            Bucket="bucket",
+            Key="key",
+            UploadId="upload-1",
+            MultipartUpload={
+                "Parts": [
+                    {"ETag": "etag-1", "PartNumber": 1},
+                    {"ETag": "etag-2", "PartNumber": 2},
+                    {"ETag": "etag-3", "PartNumber": 3},
+                ]
+            },
+        )
+
+    def test_abort_on_error(self):
+        client = self._client()
+        with pytest.raises(ValueError):
+            with S3MultipartWriter(client, "bucket", "key", part_size=10) as fileobj:
+                fileobj.write(b"x" * 20)
+                raise ValueError("export failed")
 
-        tmp_file = mock_obj.upload_file.call_args[0][0]
-        assert pattern.search(tmp_file)
+        client.abort_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="key", UploadId="upload-1"
+        )
+        assert not client.complete_multipart_upload.called
+        assert not client.put_object.called
+
+    def test_abort_on_failed_part(self):
+        client = self._client()
+        client.upload_part.side_effect = IOError("connection reset")
+        with pytest.raises(IOError):
+            with S3MultipartWriter(client, "bucket", "key", part_size=10) as fileobj:
+                fileobj.write(b"x" * 20)
+
+        assert client.abort_multipart_upload.called
+        assert not client.complete_multipart_upload.called
+
+    def test_abort_on_failed_part_in_close(self):
+        client = self._client()
+
+        def upload_part(**kw):
+            if kw["PartNumber"] == 1:
+                raise IOError("connection reset")
+            return {"ETag": "etag-%s" % kw["PartNumber"]}
+
+        client.upload_part.side_effect = upload_part
+        with pytest.raises(IOError):
+            with S3MultipartWriter(
+                client, "bucket", "key", part_size=10, workers=2
+            ) as fileobj:
+                fileobj.write(b"x" * 12)
+                fileobj.write(b"x" * 12)
+                # The tail part waits for the failed first part in close()
+                fileobj.write(b"x" * 6)
+
+        client.abort_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="key", UploadId="upload-1"
+        )
+        assert not client.complete_multipart_upload.called
+        assert fileobj._executor._shutdown
 
 
 @pytest.fixture
@@ -175,6 +392,21 @@ UK,United Kingdom
         with pytest.raises(InvalidCSV):
             read_stations_from_csv(session, csv, redis_client, cellarea_queue)
 
+    def test_radio_case(self):
+        """Radio types in another case are accepted."""
+        row = (
+            "gsm,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,"
+        )
+        _, validated, error = public._validate_station_row(row.split(","))
+        assert error is None
+        assert validated["radio"] == Radio.gsm
+
+    def test_radio_padded(self):
+        """Radio types with surrounding whitespace are rejected."""
+        row = " GSM ,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,"
+        with pytest.raises(InvalidCSV, match="Unknown radio type"):
+            public._validate_station_row(row.split(","))
+
     def test_new_stations(self, session, redis_client, cellarea_queue):
         """New stations are imported, creating cell areas and region stats."""
         csv = StringIO(
@@ -228,6 +460,50 @@ LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
         expected = [("FR", 1, 0, 0, 0, 0), ("GR", 0, 1, 1, 0, 0)]
         assert actual == expected
 
+    def test_new_stations_with_pool(self, session, redis_client, cellarea_queue):
+        """Rows can be validated by a pool of workers."""
+        csv = StringIO(
+            """\
+radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+GSM,208,10,30014,20669,,202.5,46.5992450,0,78,1,1566307030,1570119413,
+LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
+"""
+        )
+        # A process pool, so the validation has to pickle its results
+        with Pool(2) as pool:
+            read_stations_from_csv(
+                session, csv, redis_client, cellarea_queue, pool=pool
+            )
+
+        wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
+        assert wcdma.lat == 38.8574351
+        assert wcdma.modified == datetime(2019, 10, 3, 16, 31, 56, tzinfo=UTC)
+        gsm_model = CellShard.shard_model(Radio.gsm)
+        assert session.query(func.count(gsm_model.cellid)).scalar() == 0
+        lte_model = CellShard.shard_model(Radio.lte)
+        assert session.query(func.count(lte_model.cellid)).scalar() == 1
+
+    def test_validate_in_pool(self):
+        """Rows are validated in order, in slices."""
+        row = "UMTS,202,1,2120,{},,23.4123167,38.8574351,0,6,1,1568220564,1570120316,"
+        rows = [row.format(cid).split(",") for cid in range(12840, 12845)]
+        rows.insert(2, ["", "203"] + rows[0][2:])
+        with Pool(2) as pool:
+            results = list(public._validate_in_pool(pool, iter(rows), size=2))
+
+        cids = [validated and validated["cid"] for _, validated, _ in results]
+        assert cids == [12840, 12841, None, 12842, 12843, 12844]
+        # Only rows without a validated result are sent back
+        assert [row for row, _, _ in results] == [None, None, rows[2], None, None, None]
+
+    def test_validate_in_pool_unknown_radio(self):
+        """An unknown radio type raised in a worker is raised here."""
+        row = "WCDMA,202,1,2120,12842,,23.4,38.8,0,6,1,1568220564,1570120316,"
+        with Pool(2) as pool:
+            with pytest.raises(InvalidCSV, match="Unknown radio type"):
+                list(public._validate_in_pool(pool, [row.split(",")]))
+
     def test_modified_station(self, session, redis_client, cellarea_queue):
         """A modified station updates existing records."""
         station_data = {
@@ -284,6 +560,31 @@ UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
         assert stat.region == "GR"
         assert stat.wcdma == 1
 
+    def test_repeated_station(self, session, redis_client, cellarea_queue):
+        """A station repeated in the same chunk of rows is merged."""
+        csv = StringIO(
+            """\
+radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+UMTS,202,1,2120,12842,,23.4123168,38.8574352,0,7,1,1568220564,1570120317,
+"""
+        )
+        with mock.patch.object(public, "LOGGER") as logger:
+            read_stations_from_csv(session, csv, redis_client, cellarea_queue)
+
+        # One station, with the newer data
+        wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
+        assert wcdma.lat == 38.8574352
+        assert wcdma.lon == 23.4123168
+        assert wcdma.samples == 7
+        assert wcdma.modified == datetime(2019, 10, 3, 16, 31, 57, tzinfo=UTC)
+        assert (
+            mock.call.info(
+                "  %s: %d new, %d updated, %d already loaded", "wcdma", 1, 1, 0
+            )
+            in logger.method_calls
+        )
+
     def test_outdated_station(self, session, redis_client, cellarea_queue):
         """An older statuon record does not update existing station records."""
         station_data = {
@@ -2,7 +2,8 @@
 """
 Import from public cell data into a local dev environment.
 
-Download from https://location.services.mozilla.com/downloads
+Download from https://location.services.mozilla.com/downloads, or pass
+the URL of an export to stream it directly into the import.
 
 This has been tested with a differential cell export (~400kB compressed).
 A full cell export (~370,000kB) contains unexpected data that will
@@ -11,11 +12,17 @@ the resources of the development environment.
 """
 
 import argparse
+from contextlib import contextmanager
+import gzip
+import io
 import logging
+from multiprocessing import Pool
 import os
 import os.path
 import sys
 
+import requests
+
 from ichnaea.conf import settings
 from ichnaea.db import db_worker_session
 from ichnaea.log import configure_logging
@@ -26,6 +33,9 @@ from ichnaea.util import gzip_open
 
 LOGGER = logging.getLogger(__name__)
 
+# Read remote exports in large blocks, instead of the 128kB reads of gzip
+DOWNLOAD_BUFFER_SIZE = 16 * 1024 * 1024
+
 
 def get_eager_celery_app():
     """Returns an eagerly configured celery app."""
@@ -41,6 +51,32 @@ def get_eager_celery_app():
     return celery_app
 
 
+@contextmanager
+def open_export(filename):
+    """
+    Open a local or remote csv.gz export for reading as text.
+
+    A remote export is decompressed and parsed while it downloads,
+    instead of being saved to a local file first.
+
+    :arg filename: a local path, or a http(s) URL
+    """
+    if not filename.startswith(("http://", "https://")):
+        with gzip_open(filename, "r") as file_handle:
+            yield file_handle
+        return
+
+    with requests.get(filename, stream=True, timeout=60.0) as response:
+        response.raise_for_status()
+        # Read the gzip data as sent, and keep the response open at the
+        # end of the data for the buffered reader
+        response.raw.decode_content = False
+        response.raw.auto_close = False
+        raw = io.BufferedReader(response.raw, buffer_size=DOWNLOAD_BUFFER_SIZE)
+        with gzip.open(raw, "rt", encoding="utf-8") as file_handle:
+            yield file_handle
+
+
 def main(argv, _db=None):
     parser = argparse.ArgumentParser(
         prog=argv[0],
@@ -49,7 +85,22 @@ def main(argv, _db=None):
             "See https://location.services.mozilla.com/downloads"
         ),
     )
-    parser.add_argument("filename", help="Path to the csv.gz import file.")
+    try:
+        # How many CPUs can this process address?
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Fallback to the CPU count
+        cpus = os.cpu_count()
+    # Leave some CPUs for the database and the main process
+    concurrency = max(1, cpus // 2)
+
+    parser.add_argument("filename", help="Path or URL of the csv.gz import file.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=concurrency,
+        help=f"How many processes to use to validate rows? (default {concurrency})",
+    )
 
     args = parser.parse_args(argv[1:])
 
@@ -58,21 +109,34 @@ def main(argv, _db=None):
         print("Set LOCAL_DEV_ENV=True in your environment.")
         return 1
 
-    filename = os.path.abspath(os.path.expanduser(args.filename))
-    if not os.path.isfile(filename):
-        print("File %s not found." % filename)
-        return 1
+    filename = args.filename
+    if not filename.startswith(("http://", "https://")):
+        filename = os.path.abspath(os.path.expanduser(filename))
+        if not os.path.isfile(filename):
+            print("File %s not found." % filename)
+            return 1
 
     configure_logging()
-    celery_app = get_eager_celery_app()
-    init_worker(celery_app)
-    cellarea_queue = celery_app.data_queues["update_cellarea"]
 
-    with db_worker_session(celery_app.db, commit=False) as session:
-        with gzip_open(filename, "r") as file_handle:
-            read_stations_from_csv(
-                session, file_handle, celery_app.redis_client, cellarea_queue
-            )
+    # Start the worker processes before opening any outside connections
+    pool = Pool(processes=args.concurrency) if args.concurrency > 1 else None
+    try:
+        celery_app = get_eager_celery_app()
+        init_worker(celery_app)
+        cellarea_queue = celery_app.data_queues["update_cellarea"]
+
+        with db_worker_session(celery_app.db, commit=False) as session:
+            with open_export(filename) as file_handle:
+                read_stations_from_csv(
+                    session,
+                    file_handle,
+                    celery_app.redis_client,
+                    cellarea_queue,
+                    pool=pool,
+                )
+    finally:
+        if pool is not None:
+            pool.terminate()
     return 0
 
 
@@ -0,0 +1,54 @@
+import gzip
+
+import pytest
+import requests.exceptions
+import requests_mock
+
+from ichnaea.data.public import read_stations_from_csv
+from ichnaea.models import CellShard, Radio
+from ichnaea.scripts.load_cell_data import open_export
+from ichnaea.taskapp.config import configure_data
+
+URL = "https://example.com/MLS-diff-cell-export-2019-10-03T170000.csv.gz"
+
+CSV = """\
+radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
+LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
+"""
+
+
+@pytest.fixture
+def cellarea_queue(redis_client, celery):
+    """Return the DataQueue for updating CellAreas by ID."""
+    return configure_data(redis_client)["update_cellarea"]
+
+
+class TestOpenExport(object):
+    def test_url(self):
+        # Enough rows for many reads, past the gzip trailer at the end
+        lines = [CSV] + ["%d,row\n" % i for i in range(100000)]
+        body = gzip.compress("".join(lines).encode())
+        with requests_mock.Mocker() as mock:
+            mock.get(URL, content=body)
+            with open_export(URL) as file_handle:
+                assert file_handle.read() == "".join(lines)
+
+    def test_url_error(self):
+        with requests_mock.Mocker() as mock:
+            mock.get(URL, status_code=404)
+            with pytest.raises(requests.exceptions.HTTPError):
+                with open_export(URL):
+                    pass
+
+    def test_url_import(self, session, redis_client, cellarea_queue):
+        with requests_mock.Mocker() as mock:
+            mock.get(URL, content=gzip.compress(CSV.encode()))
+            with open_export(URL) as file_handle:
+                read_stations_from_csv(
+                    session, file_handle, redis_client, cellarea_queue
+                )
+
+        for radio in (Radio.gsm, Radio.wcdma, Radio.lte):
+            assert session.query(CellShard.shard_model(radio)).count() == 1
@@ -7,6 +7,7 @@ from kombu import Queue
 from ichnaea.cache import configure_redis
 from ichnaea.db import configure_db
 from ichnaea.geoip import configure_geoip
+from ichnaea.http import configure_http_session
 from ichnaea.log import configure_raven, configure_stats
 from ichnaea.models import BlueShard, CellShard, DataMap, WifiShard
 from ichnaea.queue import DataQueue
@@ -77,7 +78,12 @@ def init_beat(beat, celery_app):
 
 
 def init_worker(
-    celery_app, _db=None, _geoip_db=None, _raven_client=None, _redis_client=None
+    celery_app,
+    _db=None,
+    _geoip_db=None,
+    _http_session=None,
+    _raven_client=None,
+    _redis_client=None,
 ):
     """
     Configure the passed in celery app, usually stored in
@@ -105,6 +111,11 @@ def init_worker(
 
     celery_app.geoip_db = configure_geoip(raven_client=raven_client, _client=_geoip_db)
 
+    # keep connections to export endpoints open between tasks
+    celery_app.http_session = configure_http_session(
+        size=4, max_retries=0, _session=_http_session
+    )
+
     # configure data queues and build set of all queues
     all_queues = {q.name: {"queue_type": "task"} for q in TASK_QUEUES}
     celery_app.data_queues = data_queues = configure_data(redis_client)
@@ -127,6 +138,8 @@ def shutdown_worker(celery_app):
     del celery_app.redis_client
     celery_app.geoip_db.close()
     del celery_app.geoip_db
+    celery_app.http_session.close()
+    del celery_app.http_session
 
     del celery_app.all_queues
     del celery_app.data_queues